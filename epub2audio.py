@@ -3,20 +3,67 @@
 
 import argparse
 import asyncio
+import hashlib
+import logging
+import os
+import pickle
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from urllib.parse import unquote
 
+import aiohttp
 import ebooklib
+from aiolimiter import AsyncLimiter
+import lxml.html
 from ebooklib import epub
 from bs4 import BeautifulSoup
 import edge_tts
 
 CHUNK_SIZE = 4000
+MAX_TTS_RETRIES = 5
+
+_SENT_SPLIT = re.compile(r"(?<=[.!?])\s+")
+_WS_RUN = re.compile(r"[ \t]+")
+_ANCHOR_SPLIT = re.compile(r"\x00SPLIT:([^\x00]+)\x00")
+_TITLE_SAFE = re.compile(r"[^\w\s-]")
+
+log = logging.getLogger("epub2audio")
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler without the per-record flush.
+
+    logging flushes after every record, one write syscall per message, which
+    adds up over thousands of chunk/chapter lines. Suppressing it lets the
+    stream buffer batch output; main flushes explicitly at chapter
+    boundaries.
+    """
+
+    def flush(self):
+        pass
+
+
+class SharedConnector(aiohttp.TCPConnector):
+    """TCP connector that survives per-session close so its pool is shared.
+
+    edge_tts opens a fresh ClientSession for every request, and a session
+    closes its connector on exit. Ignoring that close keeps the pooled TLS
+    connections and DNS cache alive across all chunks, saving a TCP+TLS+WS
+    handshake per request. Call shutdown() once when the run is over.
+    """
+
+    def close(self, *args, **kwargs):
+        async def _noop():
+            return None
+        return _noop()
+
+    def shutdown(self):
+        return super().close()
 
 
 def flatten_toc(toc):
@@ -35,19 +82,38 @@ def flatten_toc(toc):
     return entries
 
 
+def normalize_text(text):
+    """Collapse space/tab runs and drop blank lines in one pass.
+
+    parse_epub returns normalized text so chunk_text can treat every line as
+    a clean non-empty paragraph and never strip again.
+    """
+    lines = (line.strip() for line in _WS_RUN.sub(" ", text).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
 def split_at_anchors(soup, anchor_ids):
-    """Split soup text at anchor ID boundaries. Returns dict of anchor_id -> text."""
-    soup = deepcopy(soup)
-    found = False
+    """Split soup text at anchor ID boundaries. Returns dict of anchor_id -> text.
+
+    Sentinel strings are inserted before each anchor and extracted again
+    after text extraction — far cheaper than deepcopying the whole tree to
+    keep the caller's soup pristine.
+    """
+    markers = []
     for aid in anchor_ids:
         el = soup.find(id=aid)
         if el:
-            el.insert_before(soup.new_string(f"\x00SPLIT:{aid}\x00"))
-            found = True
-    if not found:
+            marker = soup.new_string(f"\x00SPLIT:{aid}\x00")
+            el.insert_before(marker)
+            markers.append(marker)
+    if not markers:
         return {None: soup.get_text(separator="\n", strip=True)}
-    full_text = soup.get_text(separator="\n", strip=True)
-    parts = re.split(r"\x00SPLIT:([^\x00]+)\x00", full_text)
+    try:
+        full_text = soup.get_text(separator="\n", strip=True)
+    finally:
+        for marker in markers:
+            marker.extract()
+    parts = _ANCHOR_SPLIT.split(full_text)
     result = {}
     if parts[0].strip():
         result[None] = parts[0].strip()
@@ -67,17 +133,14 @@ def parse_with_toc(book, toc_entries):
         filename, anchor = href.split('#', 1) if '#' in href else (href, None)
         parsed_toc.append((title, filename, anchor))
     items = {}
+    by_basename = {}
     for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
         name = item.get_name()
         items[name] = item
-        parts = name.split('/')
-        for i in range(1, len(parts)):
-            subpath = '/'.join(parts[i:])
-            if subpath not in items:
-                items[subpath] = item
+        by_basename.setdefault(Path(name).name, item)
     toc_by_item = {}
     for title, filename, anchor in parsed_toc:
-        item = items.get(filename)
+        item = items.get(filename) or by_basename.get(Path(filename).name)
         if not item:
             continue
         name = item.get_name()
@@ -89,7 +152,7 @@ def parse_with_toc(book, toc_entries):
         item = book.get_item_with_id(spine_id)
         if not item:
             continue
-        soup = BeautifulSoup(item.get_body_content(), "html.parser")
+        soup = BeautifulSoup(item.get_body_content(), "lxml")
         name = item.get_name()
         if name in toc_by_item:
             entries = toc_by_item[name]
@@ -134,16 +197,43 @@ def parse_with_toc(book, toc_entries):
     return chapters
 
 
+def _parse_document(content):
+    """Extract (title, text) from one document's raw HTML bytes (process pool worker).
+
+    Builds the full tree: iterparse events can fire before an element's
+    text/tail nodes are complete, silently dropping text that straddles the
+    parser's read buffer, so streaming extraction is not safe here. The
+    title is the text of the first h1/h2/h3.
+    """
+    if not content or not content.strip():
+        return None, ""
+    root = lxml.html.fromstring(content)
+    title = None
+    for tag in ("h1", "h2", "h3"):
+        el = root.find(f".//{tag}")
+        if el is not None:
+            heading = "".join(el.itertext()).strip()
+            if heading:
+                title = heading
+                break
+    return title, "\n".join(s.strip() for s in root.itertext() if s.strip())
+
+
 def parse_with_spine(book):
     """Extract chapters in spine order (fallback when no TOC). Returns list of (title, text) tuples."""
-    chapters = []
-    pending_text = ""
+    contents = []
     for spine_id, _ in book.spine:
         item = book.get_item_with_id(spine_id)
-        if not item:
-            continue
-        soup = BeautifulSoup(item.get_body_content(), "html.parser")
-        text = soup.get_text(separator="\n", strip=True)
+        if item:
+            contents.append(item.get_body_content())
+    if len(contents) >= 8:
+        with ProcessPoolExecutor() as executor:
+            parsed = list(executor.map(_parse_document, contents, chunksize=4))
+    else:
+        parsed = [_parse_document(content) for content in contents]
+    chapters = []
+    pending_text = ""
+    for heading, text in parsed:
         if not text:
             continue
         if len(text.strip()) < 50:
@@ -152,10 +242,7 @@ def parse_with_spine(book):
         if pending_text:
             text = pending_text + text
             pending_text = ""
-        heading = soup.find(["h1", "h2", "h3"])
-        title = heading.get_text(strip=True) if heading else None
-        if not title:
-            title = text.strip().split("\n")[0][:80]
+        title = heading or text.strip().split("\n")[0][:80]
         chapters.append((title, text))
     if pending_text and chapters:
         title, text = chapters[-1]
@@ -163,49 +250,100 @@ def parse_with_spine(book):
     return chapters
 
 
-def parse_epub(epub_path):
-    """Extract chapters from epub using NCX TOC, falling back to spine order."""
+def parse_epub(epub_path, cache_dir=None):
+    """Extract chapters from epub using NCX TOC, falling back to spine order.
+
+    When cache_dir is given, the parsed chapter list is pickled under a
+    content-hash key so re-runs (e.g. resuming after a TTS failure) skip
+    parsing entirely.
+    """
+    cache_path = None
+    if cache_dir:
+        key = hashlib.blake2b(Path(epub_path).read_bytes(), digest_size=16).hexdigest()
+        cache_path = Path(cache_dir) / f"{key}.pkl"
+        if cache_path.exists():
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
     book = epub.read_epub(epub_path)
     toc_entries = flatten_toc(book.toc)
-    if toc_entries:
-        chapters = parse_with_toc(book, toc_entries)
-        if chapters:
-            return chapters
-    return parse_with_spine(book)
-
-
-def chunk_text(text, max_size=CHUNK_SIZE):
-    """Split text into chunks at paragraph boundaries, respecting max_size."""
-    paragraphs = text.split("\n")
-    chunks = []
-    current = ""
-    for para in paragraphs:
-        para = para.strip()
-        if not para:
-            continue
-        if len(current) + len(para) + 1 > max_size:
-            if current:
-                chunks.append(current)
-            if len(para) > max_size:
-                sentences = re.split(r"(?<=[.!?])\s+", para)
-                for sentence in sentences:
-                    if len(current) + len(sentence) + 1 > max_size:
-                        if current:
-                            chunks.append(current)
-                        current = sentence
-                    else:
-                        current = f"{current} {sentence}".strip()
+    chapters = parse_with_toc(book, toc_entries) if toc_entries else []
+    if not chapters:
+        chapters = parse_with_spine(book)
+    chapters = [(title, normalize_text(text)) for title, text in chapters]
+    if cache_path and chapters:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            pickle.dump(chapters, f)
+    return chapters
+
+
+def chunk_text(text: str, max_size: int = CHUNK_SIZE) -> list[str]:
+    """Split normalized text (see normalize_text) into chunks at paragraph boundaries, respecting max_size."""
+    chunks: list[str] = []
+    buf: list[str] = []
+    buf_len = 0
+    flush = chunks.append
+    split_sentences = _SENT_SPLIT.split
+    for para in text.splitlines():
+        para_len = len(para)
+        if buf_len + para_len + 1 > max_size:
+            if buf:
+                flush("".join(buf))
+                buf = []
+                buf_len = 0
+            if para_len > max_size:
+                for sentence in split_sentences(para):
+                    if buf_len + len(sentence) + 1 > max_size and buf:
+                        flush("".join(buf))
+                        buf = []
+                        buf_len = 0
+                    if buf:
+                        buf.append(" ")
+                        buf_len += 1
+                    buf.append(sentence)
+                    buf_len += len(sentence)
             else:
-                current = para
+                buf = [para]
+                buf_len = para_len
         else:
-            current = f"{current}\n{para}".strip()
-    if current:
-        chunks.append(current)
+            if buf:
+                buf.append("\n")
+                buf_len += 1
+            buf.append(para)
+            buf_len += para_len
+    if buf:
+        flush("".join(buf))
     return chunks
 
 
-def concat_mp3s(input_paths, output_path):
-    """Concatenate MP3 files using ffmpeg."""
+def append_file(src, out):
+    """Append an open binary file to out, zero-copy via sendfile when the OS allows."""
+    offset = 0
+    try:
+        size = os.fstat(src.fileno()).st_size
+        while offset < size:
+            sent = os.sendfile(out.fileno(), src.fileno(), offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        # sendfile to a regular file is Linux-only; fall back to a userland copy.
+        src.seek(offset)
+        shutil.copyfileobj(src, out, length=1 << 20)
+
+
+def concat_mp3s(input_paths, output_path, reencode=False):
+    """Concatenate MP3 files by appending their bytes, or via ffmpeg when reencode is set.
+
+    Edge TTS emits headerless MP3 frame streams (no ID3 tags, no VBR header),
+    so the frames of one file decode fine appended after another.
+    """
+    if not reencode:
+        with open(output_path, "wb") as out:
+            for path in input_paths:
+                with open(path, "rb") as src:
+                    append_file(src, out)
+        return
     with tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False) as f:
         for path in input_paths:
             escaped = str(Path(path).resolve()).replace("'", "'\\''")
@@ -217,16 +355,45 @@ def concat_mp3s(input_paths, output_path):
             capture_output=True,
         )
         if result.returncode != 0:
-            print(f"  ffmpeg error: {result.stderr.decode(errors='replace')[-500:]}")
+            log.info(f"  ffmpeg error: {result.stderr.decode(errors='replace')[-500:]}")
             result.check_returncode()
     finally:
         Path(list_file).unlink()
 
 
-async def tts_chunk(text, voice, rate, output_path):
-    """Convert a single text chunk to MP3 via Edge TTS."""
-    communicate = edge_tts.Communicate(text, voice, rate=rate)
-    await communicate.save(output_path)
+async def tts_chunk(text, voice, rate, semaphore, limiter, connector, cache_dir, cache_index):
+    """Synthesize a text chunk via Edge TTS and return its MP3 bytes, retrying with backoff.
+
+    Audio is cached under a hash of (voice, rate, text), so re-runs skip the
+    network round trip for chunks that were already synthesized. cache_index
+    is the set of cache filenames scanned once at startup, checked in place
+    of per-chunk exists()/stat() calls.
+    """
+    key = hashlib.blake2b(f"{voice}|{rate}|{text}".encode(), digest_size=16).hexdigest()
+    name = f"{key}.mp3"
+    cache_path = cache_dir / name
+    if name in cache_index:
+        return cache_path.read_bytes()
+    async with semaphore:
+        for attempt in range(MAX_TTS_RETRIES):
+            try:
+                async with limiter:
+                    communicate = edge_tts.Communicate(text, voice, rate=rate, connector=connector)
+                    audio = bytearray()
+                    async for message in communicate.stream():
+                        if message["type"] == "audio":
+                            audio.extend(message["data"])
+                if not audio:
+                    raise edge_tts.exceptions.NoAudioReceived("no audio in stream")
+                cache_path.write_bytes(audio)
+                cache_index.add(name)
+                return bytes(audio)
+            except (edge_tts.exceptions.EdgeTTSException, aiohttp.ClientError) as e:
+                if attempt == MAX_TTS_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt
+                log.info(f"    TTS error ({e}), retrying in {delay}s...")
+                await asyncio.sleep(delay)
 
 
 def pad_width(total):
@@ -234,80 +401,109 @@ def pad_width(total):
     return len(str(total))
 
 
-async def convert_chapter(chapter_num, title, text, voice, rate, output_dir, chapter_pad):
-    """Convert a full chapter to MP3, chunking if needed."""
-    safe_title = re.sub(r"[^\w\s-]", "", title)[:50].strip()
+async def convert_chapter(chapter_num, total, title, text, voice, rate, output_dir, chapter_pad, semaphore, limiter, connector, cache_dir, cache_index, existing):
+    """Convert a full chapter to MP3, chunking if needed.
+
+    existing maps chapter number -> path of a non-empty chapter file from a
+    previous run (scanned once in main); those chapters are skipped before
+    any title sanitizing or stat calls.
+    """
+    existing_path = existing.get(chapter_num)
+    if existing_path:
+        log.info(f"[{chapter_num}/{total}] {title}\n  Skipping (exists): {existing_path.name}")
+        return existing_path
+    safe_title = _TITLE_SAFE.sub("", title)[:50].strip()
     num = str(chapter_num).zfill(chapter_pad)
     filename = f"{num} {safe_title}.mp3" if safe_title else f"{num}.mp3"
     chapter_path = output_dir / filename
-    if chapter_path.exists() and chapter_path.stat().st_size > 0:
-        print(f"  Skipping (exists): {filename}")
-        return chapter_path
-    if chapter_path.exists():
-        chapter_path.unlink()
     chunks = chunk_text(text)
     if not chunks:
         return None
-    if len(chunks) == 1:
-        await tts_chunk(chunks[0], voice, rate, str(chapter_path))
-    else:
-        chunk_pad = pad_width(len(chunks))
-        tmp_dir = output_dir / "_tmp"
-        tmp_dir.mkdir(exist_ok=True)
-        chunk_paths = []
-        for i, chunk in enumerate(chunks):
-            tmp_path = tmp_dir / f"ch{str(chapter_num).zfill(chapter_pad)}_chunk{str(i).zfill(chunk_pad)}.mp3"
-            if tmp_path.exists() and tmp_path.stat().st_size > 0:
-                print(f"    Chunk {i} exists, skipping")
-            else:
-                if tmp_path.exists():
-                    tmp_path.unlink()
-                await tts_chunk(chunk, voice, rate, str(tmp_path))
-            chunk_paths.append(tmp_path)
-        concat_mp3s(chunk_paths, chapter_path)
-        for p in chunk_paths:
-            p.unlink()
-        if not any(tmp_dir.iterdir()):
-            tmp_dir.rmdir()
+    audio_parts = await asyncio.gather(*[tts_chunk(chunk, voice, rate, semaphore, limiter, connector, cache_dir, cache_index) for chunk in chunks])
+    with open(chapter_path, "wb") as out:
+        for part in audio_parts:
+            out.write(part)
+    log.info(f"[{chapter_num}/{total}] {title}")
+    sys.stdout.flush()
     return chapter_path
 
 
+def setup_logging():
+    """Send messages to stdout through the buffered handler."""
+    if log.handlers:
+        return
+    handler = BufferedStreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+
 async def main():
+    setup_logging()
     parser = argparse.ArgumentParser(description="Convert EPUB to audiobook using Edge TTS")
     parser.add_argument("epub_file", help="Path to .epub file")
     parser.add_argument("--voice", default="ru-RU-DmitryNeural", help="Edge TTS voice ID")
     parser.add_argument("--output", default="./output", help="Output directory")
     parser.add_argument("--no-merge", action="store_true", help="Skip creating combined MP3")
     parser.add_argument("--rate", default="+0%", help="Speech rate adjustment (e.g. +10%%, -5%%)")
+    parser.add_argument("--concurrency", type=int, default=6, help="Max simultaneous TTS requests")
+    parser.add_argument("--requests-per-minute", type=int, default=30, help="Max TTS requests per minute")
+    parser.add_argument("--reencode", action="store_true", help="Merge chapters through ffmpeg instead of byte concatenation")
     args = parser.parse_args()
     epub_path = Path(args.epub_file)
     if not epub_path.exists():
-        print(f"Error: file not found: {epub_path}")
+        log.info(f"Error: file not found: {epub_path}")
+        sys.stdout.flush()
         sys.exit(1)
     book_name = epub_path.stem
     output_dir = Path(args.output) / book_name
     output_dir.mkdir(parents=True, exist_ok=True)
-    print(f"Parsing: {epub_path.name}")
-    chapters = parse_epub(str(epub_path))
+    log.info(f"Parsing: {epub_path.name}")
+    chapters = parse_epub(str(epub_path), cache_dir=output_dir / ".cache")
     if not chapters:
-        print("Error: no chapters found in epub")
+        log.info("Error: no chapters found in epub")
+        sys.stdout.flush()
         sys.exit(1)
-    print(f"Found {len(chapters)} chapters")
-    print(f"Voice: {args.voice} | Rate: {args.rate}")
-    print(f"Output: {output_dir}\n")
+    log.info(f"Found {len(chapters)} chapters")
+    log.info(f"Voice: {args.voice} | Rate: {args.rate}")
+    log.info(f"Output: {output_dir}\n")
     chapter_pad = pad_width(len(chapters))
-    chapter_paths = []
-    for i, (title, text) in enumerate(chapters, 1):
-        print(f"[{i}/{len(chapters)}] {title}")
-        path = await convert_chapter(i, title, text, args.voice, args.rate, output_dir, chapter_pad)
-        if path:
-            chapter_paths.append(path)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limiter = AsyncLimiter(args.requests_per_minute, time_period=60)
+    connector = SharedConnector(limit=args.concurrency, limit_per_host=args.concurrency, ttl_dns_cache=300)
+    tts_cache_dir = output_dir / ".tts_cache"
+    tts_cache_dir.mkdir(exist_ok=True)
+    cache_index = {entry.name for entry in os.scandir(tts_cache_dir) if entry.stat().st_size > 0}
+    existing = {}
+    for entry in os.scandir(output_dir):
+        prefix = entry.name[:chapter_pad]
+        if not (entry.name.endswith(".mp3") and prefix.isdigit()):
+            continue
+        # Chapter files are exactly "<num>.mp3" or "<num> <title>.mp3"; anything
+        # else (e.g. "1984_complete.mp3" for a digit-leading book name) is not ours.
+        rest = entry.name[chapter_pad:]
+        if (rest == ".mp3" or rest.startswith(" ")) and entry.stat().st_size > 0:
+            existing[int(prefix)] = Path(entry.path)
+    tasks = [
+        asyncio.create_task(convert_chapter(i, len(chapters), title, text, args.voice, args.rate, output_dir, chapter_pad, semaphore, limiter, connector, tts_cache_dir, cache_index, existing))
+        for i, (title, text) in enumerate(chapters, 1)
+    ]
+    try:
+        chapter_paths = [path for path in await asyncio.gather(*tasks) if path]
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        await connector.shutdown()
     if not args.no_merge and len(chapter_paths) > 1:
-        print(f"\nMerging {len(chapter_paths)} chapters...")
+        log.info(f"\nMerging {len(chapter_paths)} chapters...")
         merged_path = output_dir / f"{book_name}_complete.mp3"
-        concat_mp3s(chapter_paths, merged_path)
-        print(f"Complete audiobook: {merged_path}")
-    print("\nDone!")
+        concat_mp3s(chapter_paths, merged_path, reencode=args.reencode)
+        log.info(f"Complete audiobook: {merged_path}")
+    log.info("\nDone!")
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":